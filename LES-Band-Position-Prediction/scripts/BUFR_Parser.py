@@ -10,6 +10,8 @@ For updates see: https://github.com/HumphreysCarter/BUFR-Data-Parser
 """
 
 
+import Instrumentation
+
 from metpy.units import units
 from urllib.request import urlopen
 from datetime import datetime
@@ -145,7 +147,18 @@ class SurfaceParameters:
         self.td2m = float(dataArray[32]) * units.degC
 
 
-def getBufkitData(model, station, run):
+class _NotModified:
+    # Returned by getBufkitData when a conditional fetch reports no update
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'NOT_MODIFIED'
+
+NOT_MODIFIED = _NotModified()
+
+
+def bufkitURL(model, station, run):
 
     # Create data URL from station and model
     if run == 'latest':
@@ -156,82 +169,216 @@ def getBufkitData(model, station, run):
     else:
         dataURL = "https://mtarchive.geol.iastate.edu/" + run.strftime('%Y/%m/%d/bufkit/%H') + "/" + model.lower() + "/" + model.lower() + '_' + station.lower() + ".buf"
 
-    try:
-        fileData = urlopen(dataURL)
-
-        # BUFKIT profile object data arrays
-        profileParams  = []
-        profileDerived = []
-        sfcParams      = []
-
-        dataString = ""
-        captureData_sdg = False
-        captureData_sfc = False
-        firstRun_sfc = True
-        timeCaptured = False
-        runTime  = -9999
-        tempData = []
-        sdgProfile = []
-
-        # Parse each line in data file
-        for line in fileData:
-            # Remove HTML data
-            line = str(line).replace("b'", "").replace("\\r\\n'", "")
-
-            # Capture Run Time
-            if timeCaptured == False and ("TIME = " in line):
-                runTime = datetime.strptime(line[line.index("TIME = ")+7:].strip(), "%y%m%d/%H%M")
-                timeCaptured = True
-
-            #
-            # Find Sounding Data Section
-            if "TMPC" in line:
-                captureData_sdg = True
-
-            # Capture sounding data and create data string
-            if captureData_sdg and ("TMPC" in line) == False and line.strip():
-
-                if '' == line or 'STN' in line:
-                    captureData_sdg = False
-                    profileParams.append(sdgProfile)
-                    sdgProfile = []
-
-                elif 'CFRL' not in line:
-                    dataArray = line.split(' ')
-
-                    if len(dataArray) == 2:
-                        soundingProfile = SoundingParameters(tempData[0], tempData[1], tempData[2], tempData[3], tempData[4], tempData[5], tempData[6], tempData[7], dataArray[0], dataArray[1])
-                        sdgProfile.append(soundingProfile)
-                        tempData = []
-                    else:
-                        tempData = dataArray
-
-
-            #
-            # Find Sfc Data Section
-            if "TD2M" in line:
-                captureData_sfc = True
-
-            # Capture surface data and create data string
-            if captureData_sfc and ("TD2M" in line) == False and line.strip():
-
-                # Search for start character and parse data
-                if "/" in line or "" == line:
-                    if not firstRun_sfc:
-                        sfcParam = SurfaceParameters(dataString.split(";"))
-                        sfcParams.append(sfcParam)
-
-                    firstRun_sfc = False
-                    dataString = line.replace("  ", " ").replace(" ", ";") + ";"
-                else:
-                    dataString += line.replace("  ", " ").replace(" ", ";") + ";"
+    return dataURL
+
 
-        # Create BUFKIT profile object from data
-        BUFKITprofile = bufkitProfile(station, model, runTime, profileParams, profileDerived, sfcParams)
-        return BUFKITprofile
+def getBufkitData(model, station, run, fetcher=None, lazy=False):
 
-    except:
+    # Pass a BufkitFetcher to reuse connections and skip unchanged files (returns NOT_MODIFIED)
+    # With lazy=True forecast hours are only decoded when accessed, see indexBufkitData
+    dataURL = bufkitURL(model, station, run)
+
+    try:
+        with Instrumentation.span('bufkit_download', model=model, station=station, run=run):
+            if fetcher is None:
+                rawData = urlopen(dataURL).read()
+            else:
+                rawData = fetcher.fetch(dataURL)
+    except Exception:
+        # Failure is counted by cause in the span
         print ('ERROR: No BUFKIT profiles found for ' + dataURL)
         return False
 
+    if rawData is None:
+        return NOT_MODIFIED
 
+    Instrumentation.addBytes('bufkit', len(rawData), model=model, station=station)
+
+    try:
+        with Instrumentation.span('bufkit_parse', model=model, station=station, run=run):
+            if lazy:
+                return indexBufkitData(rawData, model, station)
+            return parseBufkitData(rawData.splitlines(keepends=True), model, station)
+    except Exception:
+        print ('ERROR: Unable to parse BUFKIT profiles from ' + dataURL)
+        return False
+
+
+def decodeLine(line):
+    return str(line).replace("b'", "").replace("\\r\\n'", "")
+
+
+def parseBufkitData(fileData, model, station):
+    # BUFKIT profile object data arrays
+    profileParams  = []
+    profileDerived = []
+    sfcParams      = []
+
+    dataString = ""
+    captureData_sdg = False
+    captureData_sfc = False
+    firstRun_sfc = True
+    timeCaptured = False
+    runTime  = -9999
+    tempData = []
+    sdgProfile = []
+
+    # Parse each line in data file
+    for line in fileData:
+        # Remove HTML data
+        line = decodeLine(line)
+
+        # Capture Run Time
+        if timeCaptured == False and ("TIME = " in line):
+            runTime = datetime.strptime(line[line.index("TIME = ")+7:].strip(), "%y%m%d/%H%M")
+            timeCaptured = True
+
+        #
+        # Find Sounding Data Section
+        if "TMPC" in line:
+            captureData_sdg = True
+
+        # Capture sounding data and create data string
+        if captureData_sdg and ("TMPC" in line) == False and line.strip():
+
+            if '' == line or 'STN' in line:
+                captureData_sdg = False
+                profileParams.append(sdgProfile)
+                sdgProfile = []
+
+            elif 'CFRL' not in line:
+                dataArray = line.split(' ')
+
+                if len(dataArray) == 2:
+                    soundingProfile = SoundingParameters(tempData[0], tempData[1], tempData[2], tempData[3], tempData[4], tempData[5], tempData[6], tempData[7], dataArray[0], dataArray[1])
+                    sdgProfile.append(soundingProfile)
+                    tempData = []
+                else:
+                    tempData = dataArray
+
+
+        #
+        # Find Sfc Data Section
+        if "TD2M" in line:
+            captureData_sfc = True
+
+        # Capture surface data and create data string
+        if captureData_sfc and ("TD2M" in line) == False and line.strip():
+
+            # Search for start character and parse data
+            if "/" in line or "" == line:
+                if not firstRun_sfc:
+                    sfcParam = SurfaceParameters(dataString.split(";"))
+                    sfcParams.append(sfcParam)
+
+                firstRun_sfc = False
+                dataString = line.replace("  ", " ").replace(" ", ";") + ";"
+            else:
+                dataString += line.replace("  ", " ").replace(" ", ";") + ";"
+
+    # Create BUFKIT profile object from data
+    BUFKITprofile = bufkitProfile(station, model, runTime, profileParams, profileDerived, sfcParams)
+    return BUFKITprofile
+
+
+def parseSoundingBlock(lines):
+    # Sounding levels between a TMPC header and the next STN line, as parsed by parseBufkitData
+    sdgProfile = []
+    tempData = []
+    for line in lines:
+        line = decodeLine(line)
+
+        if line.strip() and 'CFRL' not in line:
+            dataArray = line.split(' ')
+
+            if len(dataArray) == 2:
+                soundingProfile = SoundingParameters(tempData[0], tempData[1], tempData[2], tempData[3], tempData[4], tempData[5], tempData[6], tempData[7], dataArray[0], dataArray[1])
+                sdgProfile.append(soundingProfile)
+                tempData = []
+            else:
+                tempData = dataArray
+
+    return sdgProfile
+
+def parseSurfaceBlock(lines):
+    # One surface row, which wraps over several lines
+    dataString = ""
+    for line in lines:
+        line = decodeLine(line)
+        if line.strip():
+            dataString += line.replace("  ", " ").replace(" ", ";") + ";"
+
+    return SurfaceParameters(dataString.split(";"))
+
+
+class LazyBlocks:
+    # Sequence that decodes byte ranges of a BUFKIT file on first access
+    def __init__(self, rawData, spans, decoder):
+        self._rawData = rawData
+        self._spans = spans
+        self._decoder = decoder
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if index not in self._cache:
+            start, end = self._spans[index]
+            self._cache[index] = self._decoder(self._rawData[start:end].splitlines(keepends=True))
+        return self._cache[index]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def indexBufkitData(rawData, model, station):
+    """
+    Single pass over the raw file recording the byte ranges of each sounding
+    block and surface row. Returns a bufkitProfile whose SoundingParameters and
+    SurfaceParameters decode a forecast hour only when it is accessed, indexed
+    the same way as parseBufkitData.
+    """
+    sdgSpans = []
+    sfcStarts = []
+    sdgStart = -1
+    captureData_sfc = False
+
+    position = 0
+    for line in rawData.splitlines(keepends=True):
+        end = position + len(line)
+
+        if b'TMPC' in line:
+            if sdgStart < 0:
+                sdgStart = end
+        elif sdgStart >= 0 and b'STN' in line and line.strip():
+            sdgSpans.append((sdgStart, position))
+            sdgStart = -1
+
+        if b'TD2M' in line:
+            captureData_sfc = True
+        elif captureData_sfc and b'/' in line and line.strip():
+            sfcStarts.append(position)
+
+        position = end
+
+    # As in parseBufkitData, a surface row is only complete once the next row starts
+    sfcSpans = list(zip(sfcStarts[:-1], sfcStarts[1:]))
+
+    # Capture Run Time
+    runTime = -9999
+    timeIndex = rawData.find(b'TIME = ')
+    if timeIndex >= 0:
+        timeLine = decodeLine(rawData[timeIndex:rawData.find(b'\n', timeIndex)+1])
+        runTime = datetime.strptime(timeLine[7:].strip(), "%y%m%d/%H%M")
+
+    profileParams = LazyBlocks(rawData, sdgSpans, parseSoundingBlock)
+    sfcParams = LazyBlocks(rawData, sfcSpans, parseSurfaceBlock)
+
+    return bufkitProfile(station, model, runTime, profileParams, [], sfcParams)
@@ -0,0 +1,264 @@
+"""
+
+Historical Backtest
+
+Replays archived model runs through the band models and scores the predicted
+band lines against radar-derived band positions. (run, station) jobs are fanned
+out over a process pool; features come from the FeatureStore, and raw BUFKIT
+files are cached on disk for runs it has not seen yet, so repeated backtests
+skip both download and feature derivation. Errors are reported per lead time:
+
+    start/mid/end distance [km] - great-circle distance between predicted and observed points
+    azimuth error [deg]         - difference in band orientation (start to end bearing)
+
+Observed times that are in a model's training dataset are left out, since the
+KNN models recall those rows and would score unrealistically well. Score a
+held-out season or file in the data/LO1_dataset.csv layout:
+
+    python Backtest.py 2019-11-01 2020-04-01 HELD_OUT_DATASET.csv
+
+"""
+
+import os
+import sys
+import joblib
+import numpy as np
+import pandas as pd
+import BUFR_Parser as BUFKIT
+import BandFeatures
+import FeatureStore
+import Instrumentation
+
+from datetime import datetime, timedelta
+from urllib.request import urlopen
+from concurrent.futures import ProcessPoolExecutor
+
+EARTH_RADIUS = 6371.0 # km
+
+POSITION_COLUMNS = ['BandStart_Latitude', 'BandStart_Longitude', 'BandMidpoint_Latitude', 'BandMidpoint_Longitude', 'BandEnd_Latitude', 'BandEnd_Longitude']
+POINTS = ['start', 'mid', 'end']
+
+DEFAULT_MODELS = {'LO1':'../models/LES_Band_Position_Model_KNN(n=2)_LO1_LatLon'}
+TRAINING_DATASETS = {'LO1':'../data/LO1_dataset.csv'}
+
+
+class ProfileCache:
+    # Raw archived BUFKIT files on disk, keyed by model/station/run
+    def __init__(self, cacheDir='../data/BUFKIT_cache'):
+        self.cacheDir = cacheDir
+
+    def path(self, model, station, run):
+        return f'{self.cacheDir}/{model}/{station}/{run.strftime("%Y%m%d%H")}.buf'
+
+    def get(self, model, station, run):
+        path = self.path(model, station, run)
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                return BUFKIT.indexBufkitData(file.read(), model, station)
+
+        with Instrumentation.span('bufkit_download', model=model, station=station, run=run):
+            rawData = urlopen(BUFKIT.bufkitURL(model, station, run)).read()
+        Instrumentation.addBytes('bufkit', len(rawData), model=model, station=station)
+
+        # Write then rename so a killed worker never leaves a truncated file behind
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(rawData)
+        os.replace(path + '.tmp', path)
+
+        return BUFKIT.indexBufkitData(rawData, model, station)
+
+
+def loadBandPositions(path):
+    """
+    Observed band positions and lake inputs by valid time from a merged dataset in
+    the data/LO1_dataset.csv layout: 'DateTime [UTC]', the POSITION_COLUMNS and
+    BandFeatures.LAKE_COLUMNS. The per-scan traces in data/BAND_POSITION are
+    reduced and joined with the lake data by 'Full LES Dataset.ipynb'.
+    """
+    observed = pd.read_csv(path, parse_dates=['DateTime [UTC]'])
+
+    missing = [column for column in POSITION_COLUMNS + BandFeatures.LAKE_COLUMNS if column not in observed.columns]
+    if missing:
+        raise ValueError(f'{path} is missing columns: {", ".join(missing)}')
+
+    return observed.drop_duplicates('DateTime [UTC]').set_index('DateTime [UTC]').sort_index()
+
+
+def excludeTrainingRows(observed, trainingPaths):
+    # Returns the observed rows whose valid times are in none of the training datasets, and the overlap count
+    trainingTimes = pd.DatetimeIndex([])
+    for path in trainingPaths:
+        trainingTimes = trainingTimes.union(pd.read_csv(path, parse_dates=['DateTime [UTC]'])['DateTime [UTC]'])
+
+    overlap = observed.index.isin(trainingTimes)
+    return observed[~overlap], int(overlap.sum())
+
+
+def backtestJobs(observed, stations, startDate, endDate, maxLead=18, interval=timedelta(hours=1)):
+    # Only runs with at least one observed valid time inside the lead window are fetched
+    observedTimes = set(observed.index.to_pydatetime())
+    jobs = []
+
+    run = startDate
+    while run <= endDate:
+        validTimes = [run + timedelta(hours=lead) for lead in range(maxLead + 1)]
+        if observedTimes.intersection(validTimes):
+            jobs += [(run, station) for station in stations]
+        run += interval
+
+    return jobs
+
+
+_worker = {}
+
+def _initWorker(modelPaths, cacheDir, storeDir, lakeInputs, metricsConfig):
+    # Models and the season's lake inputs are loaded once per worker process
+    Instrumentation.initWorker(metricsConfig)
+    _worker['models'] = {station:joblib.load(path) for station, path in modelPaths.items()}
+    _worker['cache'] = ProfileCache(cacheDir)
+    _worker['store'] = FeatureStore.FeatureStore(storeDir)
+    _worker['lake'] = lakeInputs
+
+def _runJob(model, run, station, maxLead):
+    # Features and predicted band positions for every observed lead time of one run
+    lakeInputs = _worker['lake']
+    cache = _worker['cache']
+
+    # Raw profiles are only read when the feature store has not seen this run
+    try:
+        profile = _worker['store'].get(model, station, run, range(maxLead + 1), loader=lambda: cache.get(model, station, run))
+    except Exception as e:
+        return run, station, type(e).__name__, None
+
+    if profile is None:
+        return run, station, 'no_data', None
+
+    profile = profile[profile.index.isin(lakeInputs.index)]
+    if len(profile) == 0:
+        return run, station, 'no_valid_times', None
+
+    lake = lakeInputs.loc[profile.index]
+    features = BandFeatures.modelInputs(profile, *[lake[column].values for column in BandFeatures.LAKE_COLUMNS])
+
+    # Levels outside the sounding (and missing lake inputs) are NaN, the models cannot use those rows
+    finite = np.isfinite(features.values).all(axis=1)
+    if not finite.all():
+        Instrumentation.count('non_finite_rows_total', int((~finite).sum()), model=model, station=station)
+        features = features[finite]
+        profile = profile[finite]
+    if len(features) == 0:
+        return run, station, 'non_finite_features', None
+
+    try:
+        with Instrumentation.span('predict', model=model, station=station, run=run):
+            predicted = _worker['models'][station].predict(features.values)
+    except Exception as e:
+        return run, station, type(e).__name__, None
+
+    result = pd.DataFrame(predicted, columns=POSITION_COLUMNS, index=features.index)
+    result['run'] = run
+    result['station'] = station
+    result['lead'] = profile['hour'].values
+
+    return run, station, 'ok', result
+
+def _runWorkerJob(model, run, station, maxLead):
+    # Metrics recorded in the worker go back to the parent with the result
+    return _runJob(model, run, station, maxLead), Instrumentation.collect()
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def bearing(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    x = np.sin(lon2 - lon1) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+    return np.degrees(np.arctan2(x, y)) % 360
+
+
+def scorePredictions(predictions, observed):
+    """
+    Vectorized error metrics for every prediction row against the observed band
+    at its valid time.
+    """
+    obs = observed.loc[predictions.index, POSITION_COLUMNS].values
+    pred = predictions[POSITION_COLUMNS].values
+
+    scores = predictions[['run', 'station', 'lead']].copy()
+    for i, point in enumerate(POINTS):
+        scores[f'{point}_km'] = haversine(pred[:, 2*i], pred[:, 2*i+1], obs[:, 2*i], obs[:, 2*i+1])
+
+    predAz = bearing(pred[:, 0], pred[:, 1], pred[:, 4], pred[:, 5])
+    obsAz = bearing(obs[:, 0], obs[:, 1], obs[:, 4], obs[:, 5])
+    scores['azimuth_error_deg'] = (predAz - obsAz + 180) % 360 - 180
+
+    return scores
+
+
+def leadTimeReport(scores):
+    metrics = {f'{point}_km':['mean', 'median'] for point in POINTS}
+    report = scores.groupby('lead').agg(metrics)
+    report.columns = [f'{name}_{stat}' for name, stat in report.columns]
+
+    azimuthError = scores.groupby('lead')['azimuth_error_deg']
+    report['azimuth_mae_deg'] = azimuthError.apply(lambda error: np.mean(np.abs(error)))
+    report['azimuth_bias_deg'] = azimuthError.mean()
+    report['count'] = scores.groupby('lead').size()
+
+    return report
+
+
+def runBacktest(observed, startDate, endDate, model='RAP', modelPaths=DEFAULT_MODELS, maxLead=18, workers=4, cacheDir='../data/BUFKIT_cache', storeDir='../data/FEATURES', trainingPaths=TRAINING_DATASETS):
+    """
+    Returns (scores, report, failures): per-prediction errors, errors aggregated
+    by lead time, and (run, station, cause) for jobs without predictions.
+    Observed times in the training datasets of the scored stations are excluded.
+    """
+    nObserved = len(observed)
+    observed, overlap = excludeTrainingRows(observed, [path for station, path in trainingPaths.items() if station in modelPaths])
+    print(f'{overlap} of {nObserved} observed times are in the training data and are excluded from scoring')
+
+    jobs = backtestJobs(observed, list(modelPaths), startDate, endDate, maxLead)
+    lakeInputs = observed[BandFeatures.LAKE_COLUMNS]
+
+    results = []
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(modelPaths, cacheDir, storeDir, lakeInputs, Instrumentation.workerConfig())) as pool:
+        futures = [pool.submit(_runWorkerJob, model, run, station, maxLead) for run, station in jobs]
+        for future in futures:
+            (run, station, status, result), metrics = future.result()
+            Instrumentation.merge(metrics)
+            if result is None:
+                failures.append((run, station, status))
+            else:
+                results.append(result)
+
+    if not results:
+        return None, None, failures
+
+    scores = scorePredictions(pd.concat(results), observed)
+    return scores, leadTimeReport(scores), failures
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        sys.exit('Usage: python Backtest.py START END HELD_OUT_DATASET.csv')
+
+    startDate = datetime.strptime(sys.argv[1], '%Y-%m-%d')
+    endDate = datetime.strptime(sys.argv[2], '%Y-%m-%d')
+    positionPath = sys.argv[3]
+
+    observed = loadBandPositions(positionPath)
+    scores, report, failures = runBacktest(observed, startDate, endDate)
+
+    print(f'{len(failures)} (run, station) jobs without predictions')
+    if report is not None:
+        print(report.round(2).to_string())
+        scores.to_csv(f'backtest_scores_{startDate:%Y%m%d}-{endDate:%Y%m%d}.csv', index=False)
+        report.to_csv(f'backtest_report_{startDate:%Y%m%d}-{endDate:%Y%m%d}.csv')
+    else:
+        print('No predictions to score')
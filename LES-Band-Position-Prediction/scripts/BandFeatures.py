@@ -0,0 +1,142 @@
+"""
+
+LES Band Model Features
+
+Environmental features used by the band position models. Columns, ordering
+and definitions of the model inputs follow data/LO1_dataset.csv, which the
+models in models/ were trained on:
+
+    lake water temperature and ice cover,
+    z, T, water-to-level lapse rate (below 500 hPa), RH, u, v at each level,
+    bulk shear from the lowest level (above the lowest level)
+
+The lapse rate and bulk shear reproduce calcLapseRate and calcWindShear in
+'Central Lake Ontario Buoy Dataset.ipynb', which built that dataset, so the
+models see the same inputs they were trained on. 'python Benchmarks.py
+features' rebuilds dataset rows through modelInputs and compares them.
+
+Features are built in two steps so the profile part can be cached per
+(model, station, run, forecast hour) in the FeatureStore:
+
+    profileFeatures - everything derived from the model profile
+    modelInputs     - adds the lake inputs and water-to-level lapse rates
+
+Bump FEATURE_VERSION when the definition changes in a way the source digest in
+FeatureStore would not catch (e.g. a changed dependency).
+
+"""
+
+import numpy as np
+import pandas as pd
+import Thermodynamics as Thermo
+
+FEATURE_VERSION = 2
+
+LEVELS = [925, 850, 700, 500]
+LAKE_COLUMNS = ['WaterTemp_Ontario [degC]', 'IceCover_Ontario [%]', 'IceCover_Huron [%]', 'IceCover_Erie [%]']
+
+
+def featureColumns(levels=LEVELS):
+    columns = list(LAKE_COLUMNS)
+    for level in levels:
+        columns += [f'z_{level}mb [m]', f'T_{level}mb [degC]']
+        if level > 500:
+            columns += [f'dT/dz_water-{level}hPa [degC/km]']
+        columns += [f'RH_{level}mb [%]', f'u_{level}mb [kt]', f'v_{level}mb [kt]']
+        if level != levels[0]:
+            columns += [f'bulkshear_{levels[0]}-{level}hPa [kt]']
+    return columns
+
+def profileColumns(levels=LEVELS):
+    return [column for column in featureColumns(levels) if column not in LAKE_COLUMNS and not column.startswith('dT/dz_water')]
+
+FEATURE_COLUMNS = featureColumns()
+PROFILE_COLUMNS = profileColumns()
+
+
+def bulkShear(uLower, vUpper):
+    # As calcWindShear in the training notebook: both shear components are taken as
+    # v_upper - u_lower, giving sqrt(2) * |v_upper - u_lower|, rounded to 0.01 kt
+    return np.round(np.sqrt(2) * np.abs(vUpper - uLower), 2)
+
+def waterLapseRate(waterTemp, T, z):
+    # As calcLapseRate in the training notebook, which uses the lowest level's
+    # temperature for every level: -(T_lowest - T_water) / z_level [degC/km]
+    return -(T - waterTemp) / (z / 1000)
+
+
+def interpolateToLevels(p, values, levels):
+    """
+    Linearly interpolate (hour x level) values in pressure to the given levels,
+    as LinearInterpolation in BUFR_Request. Levels outside a sounding are NaN.
+    """
+    output = np.full((p.shape[0], len(levels)), np.nan)
+    for row in range(p.shape[0]):
+        valid = ~np.isnan(p[row])
+        # np.interp needs increasing x, soundings are ordered by decreasing pressure
+        output[row] = np.interp(levels, p[row][valid][::-1], values[row][valid][::-1], left=np.nan, right=np.nan)
+    return output
+
+
+def profileFeatures(bufrData, hours, levels=LEVELS):
+    """
+    Profile-derived feature rows (PROFILE_COLUMNS) for the given forecast hours
+    of a bufkitProfile, indexed by valid time, with the forecast hour in 'hour'.
+    """
+    sounding = Thermo.soundingArrays(bufrData, hours)
+    derived = Thermo.thermodynamics(sounding['p'], sounding['T'], sounding['Td'], sounding['speed'], sounding['direction'])
+
+    p = sounding['p'].to('hPa').magnitude
+    atLevels = {name:interpolateToLevels(p, values, levels) for name, values in
+                [('z', sounding['z'].to('meters').magnitude), ('T', sounding['T'].to('degC').magnitude),
+                 ('Td', sounding['Td'].to('degC').magnitude), ('u', derived['u_wind'].to('knots').magnitude),
+                 ('v', derived['v_wind'].to('knots').magnitude)]}
+
+    rh = Thermo.relativeHumidity(atLevels['T'] + 273.15, atLevels['Td'] + 273.15)
+
+    validTimes = [bufrData.SurfaceParameters[hour].date for hour in hours]
+
+    profile = levelFeatures(atLevels['z'], atLevels['T'], rh, atLevels['u'], atLevels['v'], pd.DatetimeIndex(validTimes, name='DateTime [UTC]'), levels)
+    profile.insert(0, 'hour', hours)
+    return profile
+
+
+def levelFeatures(z, T, rh, u, v, index, levels=LEVELS):
+    """
+    Profile feature rows (PROFILE_COLUMNS) from (row x level) values at the given
+    levels.
+    """
+    features = {}
+    for i, level in enumerate(levels):
+        features[f'z_{level}mb [m]'] = z[:, i]
+        features[f'T_{level}mb [degC]'] = T[:, i]
+        features[f'RH_{level}mb [%]'] = rh[:, i]
+        features[f'u_{level}mb [kt]'] = u[:, i]
+        features[f'v_{level}mb [kt]'] = v[:, i]
+        if i > 0:
+            features[f'bulkshear_{levels[0]}-{level}hPa [kt]'] = bulkShear(u[:, 0], v[:, i])
+
+    return pd.DataFrame(features, index=index)[profileColumns(levels)]
+
+
+def modelInputs(profile, waterTemp, iceOntario=0.0, iceHuron=0.0, iceErie=0.0, levels=LEVELS):
+    """
+    Model input rows (FEATURE_COLUMNS) from profileFeatures output. Lake inputs
+    may be scalars or one value per row.
+    """
+    inputs = pd.DataFrame(index=profile.index)
+    inputs[LAKE_COLUMNS[0]] = waterTemp
+    inputs[LAKE_COLUMNS[1]] = iceOntario
+    inputs[LAKE_COLUMNS[2]] = iceHuron
+    inputs[LAKE_COLUMNS[3]] = iceErie
+
+    for column in profileColumns(levels):
+        inputs[column] = profile[column].values
+
+    for level in levels:
+        if level > 500:
+            T = inputs[f'T_{levels[0]}mb [degC]']
+            z = inputs[f'z_{level}mb [m]']
+            inputs[f'dT/dz_water-{level}hPa [degC/km]'] = waterLapseRate(inputs[LAKE_COLUMNS[0]], T, z)
+
+    return inputs[featureColumns(levels)]
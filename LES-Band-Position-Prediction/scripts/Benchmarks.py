@@ -0,0 +1,267 @@
+"""
+
+Pipeline Benchmarks
+
+Validation and timing for the optimized pipeline pieces.
+
+    python Benchmarks.py thermo     # Thermodynamics kernel (alone and with soundingArrays) vs. per-level MetPy
+    python Benchmarks.py fetch      # Conditional polling against a local HTTP stand-in
+    python Benchmarks.py lazy       # Analysis-hour extraction, lazy index vs. full parse
+    python Benchmarks.py features   # Model inputs rebuilt from data/LO1_dataset.csv rows
+
+"""
+
+import sys
+import time
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+import metpy.calc as mpcalc
+import BUFR_Parser as BUFKIT
+import BandFeatures
+import Thermodynamics as Thermo
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import formatdate
+from BufkitFetcher import BufkitFetcher
+
+from metpy.units import units
+
+# Maximum absolute difference allowed between the kernel and MetPy
+THERMO_TOLERANCE = {'theta':1e-3, 'theta_e':1e-3, 'relative_humidity':1e-3, 'u_wind':1e-6, 'v_wind':1e-6}
+
+# Maximum absolute difference allowed between rebuilt model inputs and the training dataset
+FEATURE_TOLERANCE = 1e-9
+
+
+def syntheticSoundings(nSoundings, nLevels=50, seed=1):
+    # Plausible cold-season profiles, surface to 100 hPa
+    rng = np.random.default_rng(seed)
+
+    p = np.linspace(1010, 100, nLevels) + rng.uniform(-5, 5, (nSoundings, 1))
+    T = 5 - 70 * (1 - p / 1010) + rng.normal(0, 2, (nSoundings, nLevels))
+    Td = T - rng.uniform(0.5, 15, (nSoundings, nLevels))
+    speed = rng.uniform(0, 80, (nSoundings, nLevels))
+    direction = rng.uniform(0, 360, (nSoundings, nLevels))
+
+    return {'p':p * units.hPa, 'T':units.Quantity(T, units.degC), 'Td':units.Quantity(Td, units.degC),
+            'speed':speed * units.knots, 'direction':direction * units.degrees}
+
+
+def metpyPerLevel(p, T, Td, speed, direction):
+    # Reference implementation: one MetPy call per level, as getDataFrame_UpperAir used to do
+    output = {name:[] for name in Thermo.OUTPUT_UNITS}
+    for i in range(len(p)):
+        output['theta'].append(mpcalc.potential_temperature(p[i], T[i]).to('kelvin').magnitude)
+        output['theta_e'].append(mpcalc.equivalent_potential_temperature(p[i], T[i], Td[i]).to('kelvin').magnitude)
+        output['relative_humidity'].append(mpcalc.relative_humidity_from_dewpoint(T[i], Td[i]).to('percent').magnitude)
+        u, v = mpcalc.wind_components(speed[i], direction[i])
+        output['u_wind'].append(u.to('knots').magnitude)
+        output['v_wind'].append(v.to('knots').magnitude)
+    return output
+
+
+def benchmarkThermodynamics(nSoundings=1000, nReference=20):
+    data = syntheticSoundings(nSoundings)
+
+    # Validate on a subset, the per-level reference is slow
+    kernel = Thermo.thermodynamics(data['p'][:nReference], data['T'][:nReference], data['Td'][:nReference], data['speed'][:nReference], data['direction'][:nReference])
+
+    passed = True
+    for name, tolerance in THERMO_TOLERANCE.items():
+        maxError = 0.0
+        for row in range(nReference):
+            reference = metpyPerLevel(data['p'][row], data['T'][row], data['Td'][row], data['speed'][row], data['direction'][row])
+            maxError = max(maxError, np.max(np.abs(kernel[name][row].magnitude - np.array(reference[name]))))
+        status = 'OK' if maxError <= tolerance else 'FAIL'
+        passed = passed and status == 'OK'
+        print(f'{name:18s} max |kernel - MetPy| = {maxError:.2e} (tolerance {tolerance:.0e}) {status}')
+
+    # Time the per-level reference and the kernel, scaled per thousand soundings
+    start = time.perf_counter()
+    for row in range(nReference):
+        metpyPerLevel(data['p'][row], data['T'][row], data['Td'][row], data['speed'][row], data['direction'][row])
+    metpySeconds = (time.perf_counter() - start) * 1000 / nReference
+
+    start = time.perf_counter()
+    Thermo.thermodynamics(data['p'], data['T'], data['Td'], data['speed'], data['direction'])
+    kernelSeconds = (time.perf_counter() - start) * 1000 / nSoundings
+
+    # As getDataFrame_UpperAir: stack parsed profiles with soundingArrays, then the kernel
+    # (file parsing is timed separately by the lazy benchmark)
+    nHours = 100
+    profile = BUFKIT.parseBufkitData(syntheticBufkitFile(nHours=nHours).splitlines(keepends=True), 'RAP', 'LO1')
+    start = time.perf_counter()
+    for run in range(max(1, nSoundings // nHours)):
+        sounding = Thermo.soundingArrays(profile, range(nHours))
+        Thermo.thermodynamics(sounding['p'], sounding['T'], sounding['Td'], sounding['speed'], sounding['direction'])
+    pipelineSeconds = (time.perf_counter() - start) * 1000 / (max(1, nSoundings // nHours) * nHours)
+
+    print(f'MetPy per-level:            {metpySeconds:.2f} s per 1000 soundings')
+    print(f'Kernel only:                {kernelSeconds:.4f} s per 1000 soundings ({metpySeconds/kernelSeconds:.0f}x)')
+    print(f'soundingArrays plus kernel: {pipelineSeconds:.2f} s per 1000 soundings ({metpySeconds/pipelineSeconds:.0f}x)')
+
+    return passed
+
+
+class _BufkitStandIn(BaseHTTPRequestHandler):
+    # Serves in-memory files with ETag/Last-Modified validators over keep-alive
+    protocol_version = 'HTTP/1.1'
+    files = {}
+
+    def do_GET(self):
+        body, modified = self.files[self.path]
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        lastModified = formatdate(modified, usegmt=True)
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', lastModified)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmarkFetch(stations=('LO1', 'LO2', 'KSYR', 'KROC'), fileSize=600000):
+    _BufkitStandIn.files = {f'/rap_{station.lower()}.buf':(b'x' * fileSize, time.time()) for station in stations}
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _BufkitStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    baseURL = f'http://127.0.0.1:{server.server_address[1]}'
+
+    def poll(fetcher, commit=True):
+        updated = [fetcher.fetch(f'{baseURL}/rap_{station.lower()}.buf') is not None for station in stations]
+        if commit:
+            fetcher.commit()
+        return updated
+
+    with BufkitFetcher() as fetcher:
+        first = poll(fetcher)
+        unchanged = poll(fetcher)
+
+        # A new run arrives for one station only
+        _BufkitStandIn.files[f'/rap_{stations[0].lower()}.buf'] = (b'y' * fileSize, time.time())
+        updated = poll(fetcher)
+
+        # Processing of the next run fails before commit(), so it is fetched again
+        _BufkitStandIn.files[f'/rap_{stations[0].lower()}.buf'] = (b'z' * fileSize, time.time())
+        failed = poll(fetcher, commit=False)
+        retried = poll(fetcher)
+
+        stats = fetcher.stats()
+
+    server.shutdown()
+    server.server_close()
+
+    onlyFirst = [True] + [False] * (len(stations) - 1)
+    passed = all(first) and not any(unchanged) and updated == onlyFirst and failed == onlyFirst and retried == onlyFirst and stats['connectionsOpened'] == 1
+
+    print(f'Polls: {stats["requests"]} requests over {stats["connectionsOpened"]} connection(s), {stats["notModified"]} not modified')
+    print(f'Bytes received: {stats["bytesReceived"]}, bytes saved: {stats["bytesSaved"]} {"OK" if passed else "FAIL"}')
+
+    return passed
+
+
+def syntheticBufkitFile(nHours=52, nLevels=50, seed=1, run=datetime(2020, 11, 1, 12)):
+    # Same layout as a RAP BUFKIT file: header, one block per forecast hour, then surface rows
+    rng = np.random.default_rng(seed)
+
+    lines = ['SNPARM = PRES;TMPC;TMWC;DWPC;THTE;DRCT;SKNT;OMEG;CFRL;HGHT',
+             'STNPRM = SHOW;LIFT;SWET;KINX;LCLP;PWAT;TOTL;CAPE;LCLT;CINS;EQLV;LFCT;BRCH', '']
+
+    for hour in range(nHours):
+        validTime = (run + timedelta(hours=hour)).strftime('%y%m%d/%H%M')
+        lines += [f'STID = LO1 STNM = 999001 TIME = {validTime}', 'SLAT = 43.62 SLON = -77.41 SELV = 75.0', f'STIM = {hour}', '',
+                  'SHOW = 10.28 LIFT = 12.61 SWET = 30.14 KINX = -9.94', 'LCLP = 906.09 PWAT = 6.65 TOTL = 38.43 CAPE = 0.00',
+                  'LCLT = 267.29 CINS = 0.00 EQLV = -9999.00 LFCT = -9999.00', 'BRCH = 0.00', '',
+                  'PRES TMPC TMWC DWPC THTE DRCT SKNT OMEG', 'CFRL HGHT']
+        for level, p in enumerate(np.linspace(1000, 100, nLevels)):
+            T = 5 - 70 * (1 - p / 1000) + rng.normal(0, 1)
+            lines.append(f'{p:.2f} {T:.2f} {T-1:.2f} {T-2:.2f} {280+level:.2f} {rng.uniform(0, 360):.2f} {rng.uniform(0, 60):.2f} 0.00')
+            lines.append(f'0.00 {100+level*300:.2f}')
+        lines.append('')
+
+    lines += ['STN YYMMDD/HHMM PMSL PRES SKTC STC1 SNFL WTNS', 'P01M C01M STC2 LCLD MCLD HCLD SNRA UWND',
+              'VWND R01M BFGR T2MS Q2MS WXTS WXTP WXTZ', 'WXTR USTM VSTM HLCY SLLH WSYM CDBP VSBK', 'TD2M']
+    for hour in range(nHours + 1):
+        values = [f'{v:.2f}' for v in rng.uniform(0, 10, 31)]
+        values[1] = '1005.00'
+        validTime = (run + timedelta(hours=hour)).strftime('%y%m%d/%H%M')
+        lines += [f'999001 {validTime} ' + ' '.join(values[0:6]), ' '.join(values[6:14]), ' '.join(values[14:22]), ' '.join(values[22:30]), values[30]]
+
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+def benchmarkLazyParse(nRuns=20):
+    rawData = syntheticBufkitFile()
+
+    # Validate every hour of the lazy reader against the full parse
+    full = BUFKIT.parseBufkitData(rawData.splitlines(keepends=True), 'RAP', 'LO1')
+    lazy = BUFKIT.indexBufkitData(rawData, 'RAP', 'LO1')
+
+    passed = full.run == lazy.run and len(full.SoundingParameters) == len(lazy.SoundingParameters) and len(full.SurfaceParameters) == len(lazy.SurfaceParameters)
+    for fullLevels, lazyLevels in zip(full.SoundingParameters, lazy.SoundingParameters):
+        passed = passed and [vars(level) for level in fullLevels] == [vars(level) for level in lazyLevels]
+    for fullRow, lazyRow in zip(full.SurfaceParameters, lazy.SurfaceParameters):
+        passed = passed and vars(fullRow) == vars(lazyRow)
+
+    print(f'{len(full.SoundingParameters)-1} forecast hours, lazy reader matches full parse: {"OK" if passed else "FAIL"}')
+
+    # Analysis-hour extraction (surface hour 0, sounding 1) as getDataFrame_UpperAir does
+    start = time.perf_counter()
+    for run in range(nRuns):
+        profile = BUFKIT.parseBufkitData(rawData.splitlines(keepends=True), 'RAP', 'LO1')
+        profile.SurfaceParameters[0], profile.SoundingParameters[1]
+    fullSeconds = (time.perf_counter() - start) * 1000 / nRuns
+
+    start = time.perf_counter()
+    for run in range(nRuns):
+        profile = BUFKIT.indexBufkitData(rawData, 'RAP', 'LO1')
+        profile.SurfaceParameters[0], profile.SoundingParameters[1]
+    lazySeconds = (time.perf_counter() - start) * 1000 / nRuns
+
+    print(f'Full parse:  {fullSeconds:.1f} s per 1000 runs')
+    print(f'Lazy index:  {lazySeconds:.1f} s per 1000 runs ({fullSeconds/lazySeconds:.0f}x)')
+
+    return passed
+
+
+def checkTrainingFeatures(datasetPath='../data/LO1_dataset.csv', nRows=200, seed=1):
+    # Rebuild a sample of training rows from their level values and lake inputs
+    dataset = pd.read_csv(datasetPath, parse_dates=['DateTime [UTC]']).set_index('DateTime [UTC]')
+    sample = dataset.sample(min(nRows, len(dataset)), random_state=seed)
+
+    atLevels = {name:sample[[f'{name}_{level}mb [{unit}]' for level in BandFeatures.LEVELS]].values
+                for name, unit in [('z', 'm'), ('T', 'degC'), ('RH', '%'), ('u', 'kt'), ('v', 'kt')]}
+    profile = BandFeatures.levelFeatures(atLevels['z'], atLevels['T'], atLevels['RH'], atLevels['u'], atLevels['v'], sample.index)
+    inputs = BandFeatures.modelInputs(profile, *[sample[column].values for column in BandFeatures.LAKE_COLUMNS])
+
+    passed = list(inputs.columns) == BandFeatures.FEATURE_COLUMNS
+    for column in BandFeatures.FEATURE_COLUMNS:
+        maxError = np.max(np.abs(inputs[column].values - sample[column].values))
+        if maxError > FEATURE_TOLERANCE:
+            passed = False
+            print(f'{column:32s} max |rebuilt - dataset| = {maxError:.2e} FAIL')
+
+    print(f'{len(sample)} dataset rows, {len(BandFeatures.FEATURE_COLUMNS)} model inputs rebuilt through modelInputs: {"OK" if passed else "FAIL"}')
+
+    return passed
+
+
+if __name__ == '__main__':
+    benchmarks = {'thermo':benchmarkThermodynamics, 'fetch':benchmarkFetch, 'lazy':benchmarkLazyParse, 'features':checkTrainingFeatures}
+
+    names = sys.argv[1:] or list(benchmarks)
+    results = [benchmarks[name]() for name in names]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,152 @@
+"""
+
+BUFKIT Fetch Layer
+
+Reuses HTTP keep-alive connections per host and sends conditional requests
+(If-None-Match / If-Modified-Since) so polling a 'latest' BUFKIT file that has
+not been updated costs a 304 instead of a full transfer. Validators can be
+persisted with statePath so a cron-driven script short-circuits across runs.
+
+Validators of a new file only take effect once commit() is called, so a run
+whose processing fails is fetched again on the next poll instead of being
+skipped as unchanged.
+
+"""
+
+import json
+import os
+import http.client
+import Instrumentation
+
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urljoin
+
+# Errors raised when the server closed an idle keep-alive connection
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest, BrokenPipeError, ConnectionResetError)
+
+
+class BufkitFetcher:
+    def __init__(self, timeout=30, statePath=''):
+        self.timeout = timeout
+        self.statePath = statePath
+
+        self.requests = 0
+        self.notModified = 0
+        self.connectionsOpened = 0
+        self.bytesReceived = 0
+        self.bytesSaved = 0
+
+        self._connections = {}
+        self._validators = {}
+        self._pending = {}
+
+        if statePath != '' and os.path.exists(statePath):
+            with open(statePath) as file:
+                self._validators = json.load(file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def fetch(self, url, redirects=3):
+        """
+        Return the body of url, or None if unchanged since the last fetch (HTTP 304).
+        """
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+
+        headers = {'Accept-Encoding':'identity', 'Connection':'keep-alive'}
+        validator = self._validators.get(url, {})
+        if validator.get('etag'):
+            headers['If-None-Match'] = validator['etag']
+        if validator.get('lastModified'):
+            headers['If-Modified-Since'] = validator['lastModified']
+
+        response, body = self._request(parts.scheme, parts.netloc, path, headers)
+        self.requests += 1
+        Instrumentation.count('requests_total', source='bufkit')
+
+        if response.status == 304:
+            self.notModified += 1
+            self.bytesSaved += validator.get('size', 0)
+            self._pending.pop(url, None)
+            Instrumentation.count('not_modified_total', source='bufkit')
+            Instrumentation.count('bytes_saved_total', validator.get('size', 0), source='bufkit')
+            return None
+
+        if response.status in (301, 302, 303, 307, 308) and redirects > 0:
+            return self.fetch(urljoin(url, response.getheader('Location')), redirects-1)
+
+        if response.status != 200:
+            raise HTTPError(url, response.status, response.reason, response.msg, None)
+
+        self._pending[url] = {'etag':response.getheader('ETag'), 'lastModified':response.getheader('Last-Modified'), 'size':len(body)}
+        self.bytesReceived += len(body)
+        Instrumentation.count('bytes_received_total', len(body), source='bufkit')
+
+        return body
+
+    def commit(self, url=None):
+        """
+        Keep the validators of url (default: every fetched url) for the next poll,
+        once its data has been fully processed, and save them to statePath.
+        """
+        urls = list(self._pending) if url is None else [url]
+        for url in urls:
+            if url in self._pending:
+                self._validators[url] = self._pending.pop(url)
+        self.save()
+
+    def stats(self):
+        return {'requests':self.requests, 'notModified':self.notModified, 'connectionsOpened':self.connectionsOpened,
+                'bytesReceived':self.bytesReceived, 'bytesSaved':self.bytesSaved}
+
+    def summary(self):
+        return (f'{self.requests} request(s) over {self.connectionsOpened} connection(s), {self.notModified} not modified, '
+                f'{self.bytesReceived} bytes received, {self.bytesSaved} bytes saved')
+
+    def save(self):
+        if self.statePath != '':
+            with open(self.statePath, 'w') as file:
+                json.dump(self._validators, file)
+
+    def close(self):
+        for connection in self._connections.values():
+            connection.close()
+        self._connections = {}
+
+    def _request(self, scheme, host, path, headers):
+        # Retry once on a fresh connection if the server dropped the idle one
+        for attempt in range(2):
+            connection = self._connection(scheme, host)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except STALE_CONNECTION_ERRORS:
+                self._drop(scheme, host)
+                if attempt == 1:
+                    raise
+
+        if response.will_close:
+            self._drop(scheme, host)
+
+        return response, body
+
+    def _connection(self, scheme, host):
+        key = (scheme, host)
+        if key not in self._connections:
+            connectionClass = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            self._connections[key] = connectionClass(host, timeout=self.timeout)
+            self.connectionsOpened += 1
+            Instrumentation.count('connections_opened_total', source='bufkit')
+        return self._connections[key]
+
+    def _drop(self, scheme, host):
+        connection = self._connections.pop((scheme, host), None)
+        if connection is not None:
+            connection.close()
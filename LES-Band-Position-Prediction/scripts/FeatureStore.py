@@ -0,0 +1,188 @@
+"""
+
+Feature Store
+
+Memoized profile features shared by training, backtesting, real-time
+prediction and the BUFR_Request batch export. Rows are keyed by (model, station, run, forecast hour, feature
+version) and computed once through BandFeatures.profileFeatures. Each run is
+persisted as one compressed columnar .npz file:
+
+    <storeDir>/<version>/<model>/<station>/<YYYYmmddHH>.npz
+
+The version combines BandFeatures.FEATURE_VERSION with a digest of the feature
+and thermodynamics code, so changing the feature definition starts a fresh
+directory and stale rows are never read; purgeStale() removes old versions.
+
+"""
+
+import os
+import shutil
+import hashlib
+import inspect
+import numpy as np
+import pandas as pd
+import BandFeatures
+import Thermodynamics
+import BUFR_Parser as BUFKIT
+import Instrumentation
+
+# Bump when the on-disk layout changes
+STORE_FORMAT = 2
+
+
+def featureVersion():
+    digest = hashlib.sha1()
+    for module in [BandFeatures, Thermodynamics]:
+        digest.update(inspect.getsource(module).encode())
+    digest.update(','.join(BandFeatures.PROFILE_COLUMNS).encode())
+    digest.update(f'format{STORE_FORMAT}'.encode())
+    return f'v{BandFeatures.FEATURE_VERSION}-{digest.hexdigest()[:10]}'
+
+
+class FeatureStore:
+    def __init__(self, storeDir='../data/FEATURES', memoryRuns=256):
+        self.storeDir = storeDir
+        self.version = featureVersion()
+        self.memoryRuns = memoryRuns
+        self._memory = {}
+
+    def path(self, model, station, run):
+        return f'{self.storeDir}/{self.version}/{model}/{station}/{run.strftime("%Y%m%d%H")}.npz'
+
+    def get(self, model, station, run, hours, loader=None):
+        """
+        Profile features (BandFeatures.PROFILE_COLUMNS) for the given forecast hours
+        of a run, indexed by valid time, or None if the run is unavailable. Missing
+        hours are computed from the bufkitProfile returned by loader() (default:
+        archived run, lazily parsed) and added to the store. Hours past the end of
+        the run are left out.
+        """
+        hours = list(hours)
+        key = (model, station, run)
+
+        stored = self._memory.get(key)
+        if stored is None:
+            stored = self._read(model, station, run)
+
+        # Number of forecast hours in the run, known once it has been loaded
+        available = stored.attrs['available'] if stored is not None else -1
+        missing = [hour for hour in hours if (stored is None or hour not in stored['hour'].values) and (available < 0 or hour < available)]
+
+        if missing:
+            if loader is None:
+                loader = lambda: BUFKIT.getBufkitData(model, station, run, lazy=True)
+
+            bufrData = loader()
+            if bufrData == False or bufrData is BUFKIT.NOT_MODIFIED:
+                return None
+
+            available = min(len(bufrData.SurfaceParameters), len(bufrData.SoundingParameters) - 1)
+            missing = [hour for hour in missing if hour < available]
+
+            if missing:
+                try:
+                    # Lazily parsed hours are decoded here
+                    with Instrumentation.span('feature_compute', model=model, station=station, run=run):
+                        computed = BandFeatures.profileFeatures(bufrData, missing)
+                except Exception:
+                    # Failure is counted by cause in the span
+                    print(f'ERROR: Unable to parse {model} profiles for {station} run {run}')
+                    return None
+
+                # Same dtypes as rows read back from disk
+                columns = BandFeatures.PROFILE_COLUMNS
+                computed[columns] = computed[columns].astype(float)
+                computed.index = computed.index.astype('datetime64[ns]')
+                stored = computed if stored is None else pd.concat([stored, computed]).sort_values('hour')
+            elif stored is None:
+                stored = pd.DataFrame(columns=['hour'] + BandFeatures.PROFILE_COLUMNS, index=pd.DatetimeIndex([], name='DateTime [UTC]'))
+
+            stored.attrs['available'] = available
+            self._write(model, station, run, stored)
+        else:
+            Instrumentation.count('feature_hits_total', model=model, station=station)
+
+        # Keep the most recently used runs in memory
+        self._memory.pop(key, None)
+        self._memory[key] = stored
+        if len(self._memory) > self.memoryRuns:
+            self._memory.pop(next(iter(self._memory)))
+
+        return stored[stored['hour'].isin(hours)]
+
+    def purgeStale(self):
+        # Remove features written by other feature versions
+        if not os.path.isdir(self.storeDir):
+            return []
+
+        stale = [name for name in os.listdir(self.storeDir) if name != self.version]
+        for name in stale:
+            shutil.rmtree(f'{self.storeDir}/{name}')
+        return stale
+
+    def _read(self, model, station, run):
+        path = self.path(model, station, run)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as data:
+            columns = list(data['columns'])
+            stored = pd.DataFrame(dict(zip(columns, data['values'].astype(float))), index=pd.DatetimeIndex(data['validTime'].astype('datetime64[ns]'), name='DateTime [UTC]'))
+            stored.insert(0, 'hour', data['hour'].astype(int))
+            stored.attrs['available'] = int(data['available'])
+
+        return stored
+
+    def _write(self, model, station, run, stored):
+        path = self.path(model, station, run)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # One contiguous float64 array per column, so exported values round exactly as
+        # freshly computed ones; write then rename so readers never see a partial file
+        columns = BandFeatures.PROFILE_COLUMNS
+        tmpPath = path[:-len('.npz')] + '.tmp.npz'
+        np.savez_compressed(tmpPath, columns=np.array(columns), values=stored[columns].values.T.astype(np.float64),
+                            hour=stored['hour'].values.astype(np.int16), validTime=stored.index.values.astype('datetime64[s]'),
+                            available=np.array(stored.attrs['available']))
+        os.replace(tmpPath, path)
+
+
+def trainingDataset(observed, model='RAP', station='LO1', store=None):
+    """
+    Training rows in the data/LO1_dataset.csv layout: for each observed band
+    time, the analysis hour of the run valid at that time (as BUFR_Request.getData)
+    joined with the observed band positions and lake inputs.
+    """
+    if store is None:
+        store = FeatureStore()
+
+    # One row per valid time, as Backtest.loadBandPositions
+    observed = observed[~observed.index.duplicated()]
+
+    rows = []
+    for validTime in observed.index:
+        profile = store.get(model, station, validTime.to_pydatetime(), [0])
+        if profile is not None and len(profile) > 0:
+            rows.append(profile)
+
+    if not rows:
+        return None
+
+    profiles = pd.concat(rows)
+    lake = observed.loc[profiles.index, BandFeatures.LAKE_COLUMNS]
+    inputs = BandFeatures.modelInputs(profiles, *[lake[column].values for column in BandFeatures.LAKE_COLUMNS])
+
+    labels = observed.loc[profiles.index].drop(columns=[column for column in observed.columns if column in inputs.columns])
+    return labels.join(inputs)
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Rebuild a training dataset from the store, e.g.
+    #   python FeatureStore.py ../data/LO1_dataset.csv ../data/LO1_dataset_features.csv
+    observed = pd.read_csv(sys.argv[1], parse_dates=['DateTime [UTC]']).set_index('DateTime [UTC]')
+    dataset = trainingDataset(observed)
+    if dataset is None:
+        sys.exit(f'No model profiles found for the times in {sys.argv[1]}')
+    dataset.to_csv(sys.argv[2])
@@ -0,0 +1,254 @@
+"""
+
+Pipeline Instrumentation
+
+Lightweight timing spans, byte counters and error counts for the batch and
+real-time pipelines. Disabled by default; when disabled every call is a no-op.
+
+Enable from code:
+    import Instrumentation
+    Instrumentation.enable('metrics.jsonl')              # JSON lines
+    Instrumentation.enable('metrics.prom', 'prometheus') # Prometheus text file
+
+or from the environment before the script starts:
+    LES_METRICS=jsonl:metrics.jsonl
+    LES_METRICS=prometheus:/var/lib/node_exporter/les.prom
+
+Process pools: pass workerConfig() to the pool initializer and call
+initWorker() there. With JSON lines, workers append to the same file. With
+Prometheus, workers return collect() alongside their result and the parent
+merge()s it, so the file written by flush() covers every process.
+
+"""
+
+import json
+import os
+import time
+import threading
+from collections import defaultdict
+
+# Labels kept when aggregating into Prometheus series, per station/hour labels
+# such as 'time' only appear in the JSON lines output
+PROMETHEUS_LABELS = ('model', 'station', 'site', 'source', 'cause')
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+    def set(self, **labels):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, metrics, stage, labels):
+        self.metrics = metrics
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        seconds = time.perf_counter() - self.start
+        status = 'ok' if excType is None else 'error'
+        self.metrics._recordSpan(self.stage, seconds, status, self.labels)
+        if excType is not None:
+            self.metrics.error(self.stage, excValue, **self.labels)
+        return False
+
+    def set(self, **labels):
+        # Attach labels only known once the stage is running (e.g. byte counts)
+        self.labels.update(labels)
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.path = ''
+        self.format = 'jsonl'
+        self._file = None
+        self._counters = defaultdict(float)
+        self._spanSum = defaultdict(float)
+        self._spanCount = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def enable(self, path, format='jsonl'):
+        if format not in ('jsonl', 'prometheus'):
+            raise ValueError(f'Unknown metrics format: {format}')
+
+        self.close()
+        self.enabled = True
+        self.path = path
+        self.format = format
+
+        if format == 'jsonl':
+            self._file = open(path, 'a', buffering=1)
+
+    def disable(self):
+        self.close()
+        self.enabled = False
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def span(self, stage, **labels):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, stage, labels)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[(name, self._seriesKey(labels))] += value
+        self._emit({'counter': name, 'value': value, **labels})
+
+    def addBytes(self, source, nbytes, **labels):
+        self.count('download_bytes_total', nbytes, source=source, **labels)
+
+    def error(self, stage, exc, **labels):
+        cause = exc if isinstance(exc, str) else type(exc).__name__
+        self.count('errors_total', 1, stage=stage, cause=cause, **labels)
+
+    def workerConfig(self):
+        return {'enabled': self.enabled, 'path': self.path, 'format': self.format}
+
+    def initWorker(self, config):
+        # Forked workers inherit the parent's aggregates and open file, start clean
+        # with the parent's settings instead (flush here would overwrite its file)
+        self._file = None
+        self._counters.clear()
+        self._spanSum.clear()
+        self._spanCount.clear()
+        self._lock = threading.Lock()
+
+        self.enabled = config['enabled']
+        self.path = config['path']
+        self.format = config['format']
+        if self.enabled and self.format == 'jsonl':
+            self._file = open(self.path, 'a', buffering=1)
+
+    def collect(self):
+        # Prometheus aggregates recorded since the last call, for a worker to return
+        # to the parent; JSON lines are already written by the worker itself
+        if not self.enabled or self.format != 'prometheus':
+            return None
+
+        with self._lock:
+            collected = (dict(self._counters), dict(self._spanSum), dict(self._spanCount))
+            self._counters.clear()
+            self._spanSum.clear()
+            self._spanCount.clear()
+        return collected
+
+    def merge(self, collected):
+        if collected is None or not self.enabled:
+            return
+
+        counters, spanSum, spanCount = collected
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] += value
+            for key, value in spanSum.items():
+                self._spanSum[key] += value
+            for key, value in spanCount.items():
+                self._spanCount[key] += value
+
+    def flush(self):
+        if not self.enabled:
+            return
+
+        if self.format == 'prometheus' and self.path != '':
+            # Write to a temporary file and rename so scrapers never see a partial file
+            tmpPath = self.path + '.tmp'
+            with open(tmpPath, 'w') as file:
+                file.write(self.prometheusText())
+            os.replace(tmpPath, self.path)
+        elif self._file is not None:
+            self._file.flush()
+
+    def prometheusText(self):
+        lines = []
+
+        # Copy under the lock, render-queue callbacks merge worker metrics from another thread
+        with self._lock:
+            spanSum, spanCount, counters = dict(self._spanSum), dict(self._spanCount), dict(self._counters)
+
+        if spanSum:
+            lines.append('# TYPE les_stage_seconds summary')
+            for key in sorted(spanSum):
+                lines.append(f'les_stage_seconds_sum{self._formatLabels(key)} {spanSum[key]:.6f}')
+                lines.append(f'les_stage_seconds_count{self._formatLabels(key)} {spanCount[key]}')
+
+        names = sorted(set(name for name, key in counters))
+        for name in names:
+            lines.append(f'# TYPE les_{name} counter')
+            for (counterName, key), value in sorted(counters.items()):
+                if counterName == name:
+                    lines.append(f'les_{name}{self._formatLabels(key)} {value:g}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _recordSpan(self, stage, seconds, status, labels):
+        key = self._seriesKey({'stage': stage, **labels})
+        with self._lock:
+            self._spanSum[key] += seconds
+            self._spanCount[key] += 1
+        self._emit({'span': stage, 'seconds': round(seconds, 6), 'status': status, **labels})
+
+    def _emit(self, record):
+        if self._file is not None:
+            record = {'ts': round(time.time(), 3), **record}
+            self._file.write(json.dumps(record, default=str) + '\n')
+
+    @staticmethod
+    def _seriesKey(labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items() if k in PROMETHEUS_LABELS or k == 'stage'))
+
+    @staticmethod
+    def _formatLabels(key):
+        if not key:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in key) + '}'
+
+
+# Shared instance used by the pipeline scripts
+metrics = Metrics()
+
+enable = metrics.enable
+disable = metrics.disable
+span = metrics.span
+count = metrics.count
+addBytes = metrics.addBytes
+error = metrics.error
+flush = metrics.flush
+close = metrics.close
+workerConfig = metrics.workerConfig
+initWorker = metrics.initWorker
+collect = metrics.collect
+merge = metrics.merge
+
+
+def configureFromEnvironment(variable='LES_METRICS'):
+    setting = os.environ.get(variable, '')
+    if setting == '' or metrics.enabled:
+        return
+
+    format, _, path = setting.partition(':')
+    if path == '':
+        format, path = 'jsonl', setting
+    enable(path, format)
+
+
+configureFromEnvironment()
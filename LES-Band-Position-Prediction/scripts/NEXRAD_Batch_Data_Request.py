@@ -10,8 +10,10 @@ For updates see: https://github.com/HumphreysCarter/AWS-NOAA-Data-Request
 """
 
 import NEXRAD_AWS_Request as NEXRAD
+import Instrumentation
 import s3fs as AWSbucket
 import pandas as pd
+import os
 from datetime import datetime, timedelta
 
 fs = AWSbucket.S3FileSystem(anon=True)
@@ -21,13 +23,17 @@ def getNEXRAD(outputDir, filePrefix, radarSite, startDate, endDate, interval):
 
     # Get files from start to end date at specified interval
     while startDate <= endDate:
-        dataFile = NEXRAD.getArchivedScan(radarSite, startDate)
+        with Instrumentation.span('nexrad_scan_lookup', site=radarSite, time=startDate):
+            dataFile = NEXRAD.getArchivedScan(radarSite, startDate)
         fileList.append(dataFile)
         startDate += interval
 
     for file in fileList:
         print('Downloading ', file, '...')
-        fs.get(file, outputDir + filePrefix + file.split('/')[-1])
+        localFile = outputDir + filePrefix + file.split('/')[-1]
+        with Instrumentation.span('nexrad_download', site=radarSite, file=file):
+            fs.get(file, localFile)
+        Instrumentation.addBytes('nexrad', os.path.getsize(localFile), site=radarSite)
 
 timeInt = 1
 
@@ -48,5 +54,8 @@ for index, row in df.iterrows():
             getNEXRAD(f'{dataDIR}/Ontario_LES_Event{str(eventID).zfill(2)}/', f'Ontario_LES_Event{str(eventID).zfill(2)}-', 'KBGM', sdate, edate, timedelta(hours=timeInt))
         else:
             getNEXRAD(f'{dataDIR}/Ontario_LES_Event{str(eventID).zfill(2)}/', f'Ontario_LES_Event{str(eventID).zfill(2)}-', 'KTYX', sdate, edate, timedelta(hours=timeInt))
-    except:
-        print(f'No data found: Ontario_LES_Event{str(eventID).zfill(2)}')
\ No newline at end of file
+    except Exception as e:
+        Instrumentation.error('get_nexrad', e, event=eventID)
+        print(f'No data found: Ontario_LES_Event{str(eventID).zfill(2)}')
+
+Instrumentation.flush()
@@ -0,0 +1,122 @@
+"""
+
+Checkpointed CSV Writer
+
+Buffers rows in memory and flushes them in batches, fsyncing the data file and
+a manifest of completed (model, station, valid time) keys at each checkpoint.
+A restarted sweep skips keys already done instead of truncating the export, and
+hours that failed are recorded in a side file for targeted retry.
+
+    <exportPath>            CSV output
+    <exportPath>.manifest   completed keys, one per line
+    <exportPath>.failed     failed keys with cause, one per line
+
+"""
+
+import os
+from datetime import datetime
+
+
+def rowKey(model, station, time):
+    # Same format as the leading columns of each CSV row
+    return f'{model},{station},{time}'
+
+def parseKey(key):
+    model, station, time = key.split(',', 2)
+    return model, station, datetime.fromisoformat(time)
+
+
+class CheckpointWriter:
+    def __init__(self, exportPath, header, flushEvery=24, resume=True):
+        self.exportPath = exportPath
+        self.manifestPath = exportPath + '.manifest'
+        self.failedPath = exportPath + '.failed'
+        self.flushEvery = flushEvery
+
+        self.completed = set()
+        self.failed = {}
+        self._rows = []
+        self._keys = []
+        self._failures = []
+
+        if resume and os.path.exists(exportPath) and os.path.getsize(exportPath) > 0:
+            self._recover()
+        else:
+            with open(exportPath, 'w') as file:
+                file.write(header + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            for path in [self.manifestPath, self.failedPath]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def isDone(self, key):
+        return key in self.completed
+
+    def write(self, key, row):
+        self._rows.append(row)
+        self._keys.append(key)
+        self.completed.add(key)
+        self.failed.pop(key, None)
+
+        if len(self._rows) >= self.flushEvery:
+            self.flush()
+
+    def fail(self, key, cause):
+        self.failed[key] = cause
+        self._failures.append(f'{key},{cause}')
+
+    def failedKeys(self):
+        return [key for key in self.failed if key not in self.completed]
+
+    def flush(self):
+        # Data is synced before the manifest so the manifest never lists rows not on disk
+        if self._rows:
+            self._append(self.exportPath, self._rows)
+            self._append(self.manifestPath, self._keys)
+            self._rows = []
+            self._keys = []
+
+        if self._failures:
+            self._append(self.failedPath, self._failures)
+            self._failures = []
+
+    def close(self):
+        self.flush()
+
+    def _recover(self):
+        # Drop a partially written last row from an interrupted flush
+        with open(self.exportPath, 'rb+') as file:
+            data = file.read()
+            if data and not data.endswith(b'\n'):
+                file.truncate(data.rfind(b'\n') + 1)
+                data = data[:data.rfind(b'\n') + 1]
+
+        # Rows flushed before the manifest was updated still count as complete
+        for line in data.decode().splitlines()[1:]:
+            self.completed.add(','.join(line.split(',', 3)[:3]))
+
+        if os.path.exists(self.manifestPath):
+            with open(self.manifestPath) as file:
+                self.completed.update(line.strip() for line in file if line.strip())
+
+        if os.path.exists(self.failedPath):
+            with open(self.failedPath) as file:
+                for line in file:
+                    if line.strip():
+                        key, cause = line.strip().rsplit(',', 1)
+                        self.failed[key] = cause
+
+    @staticmethod
+    def _append(path, lines):
+        with open(path, 'a') as file:
+            file.write('\n'.join(lines) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
@@ -0,0 +1,126 @@
+"""
+
+Skew-T Render Queue
+
+Hands sounding arrays to a pool of worker processes for Skew-T output so data
+extraction is not blocked on plotting. The queue is bounded: submit() blocks
+once maxPending plots are in flight, keeping memory flat on long sweeps.
+
+Modes:
+    'sync'       - render in the calling process (previous behaviour)
+    'background' - render in worker processes
+    'skip'       - do not render
+
+With onlyMissing=True, plots whose output file already exists are not redrawn.
+
+"""
+
+import os
+import threading
+import pandas as pd
+import Instrumentation
+
+from concurrent.futures import ProcessPoolExecutor
+from metpy.units import units
+
+MODES = ('sync', 'background', 'skip')
+
+
+def skewTPath(exportPath, time):
+    plotPath=exportPath.replace('data/BUFKIT', 'plots/SkewT')
+    return plotPath.replace('.csv', time.strftime("_SkewT_%Y%m%d_%H%M")+'.png')
+
+
+def packSounding(df):
+    # Plain magnitudes and unit strings pickle far smaller than per-level Quantities
+    return {name:([value.magnitude for value in df[name]], str(df[name].iloc[0].units)) for name in df.columns}
+
+def unpackSounding(columns):
+    return pd.DataFrame({name:[units.Quantity(value, unit) for value in values] for name, (values, unit) in columns.items()})
+
+
+def renderSkewT(model, time, station, df, plotPath):
+    import matplotlib.pyplot as plt
+    import SkewT
+
+    try:
+        plot = SkewT.drawSkewT([model, time, 0, station, df], 10, 10, 100, True, 250, True, False, False, True, True)
+        plot.savefig(plotPath, bbox_inches='tight')
+    finally:
+        plt.close('all')
+
+    return plotPath
+
+def _initWorker(metricsConfig):
+    Instrumentation.initWorker(metricsConfig)
+
+def _renderWorker(model, time, station, columns, plotPath):
+    import matplotlib
+    matplotlib.use('Agg')
+
+    with Instrumentation.span('skewt_render', model=model, station=station, time=time):
+        renderSkewT(model, time, station, unpackSounding(columns), plotPath)
+
+    # Metrics recorded in the worker go back to the parent with the result
+    return plotPath, Instrumentation.collect()
+
+
+class SkewTRenderQueue:
+    def __init__(self, mode='background', workers=2, maxPending=8, onlyMissing=False):
+        if mode not in MODES:
+            raise ValueError(f'Unknown render mode: {mode}')
+
+        self.mode = mode
+        self.onlyMissing = onlyMissing
+        self.failed = []
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(maxPending)
+
+        if mode == 'background':
+            self._pool = ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(Instrumentation.workerConfig(),))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def submit(self, model, time, station, df, plotPath):
+        if self.mode == 'skip' or (self.onlyMissing and os.path.exists(plotPath)):
+            return
+
+        if self.mode == 'sync':
+            # Plotting failures never block data extraction, as in background mode
+            try:
+                with Instrumentation.span('skewt_render', model=model, station=station, time=time):
+                    renderSkewT(model, time, station, df, plotPath)
+            except Exception as e:
+                self.failed.append(plotPath)
+                print(f'ERROR rendering Skew-T {plotPath}: {e}')
+            return
+
+        # Blocks while the queue is full
+        with Instrumentation.span('skewt_enqueue', model=model, station=station, time=time):
+            self._slots.acquire()
+
+        future = self._pool.submit(_renderWorker, model, time, station, packSounding(df), plotPath)
+        future.add_done_callback(lambda future, plotPath=plotPath: self._done(future, plotPath))
+
+    def close(self, wait=True):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+    def _done(self, future, plotPath):
+        self._slots.release()
+        if future.exception() is not None:
+            Instrumentation.error('skewt_render', future.exception())
+            self.failed.append(plotPath)
+            print(f'ERROR rendering Skew-T {plotPath}: {future.exception()}')
+        else:
+            Instrumentation.merge(future.result()[1])
+
+
+# Default used when getData is called without a queue
+syncQueue = SkewTRenderQueue(mode='sync')
@@ -0,0 +1,128 @@
+"""
+
+Vectorized Thermodynamics Kernel
+
+Computes potential temperature, equivalent potential temperature, relative
+humidity and wind components for whole (hour x level) arrays in one call.
+Units are checked once at the boundary (soundingArrays / thermodynamics);
+the kernel functions work on plain numpy magnitudes and follow the same
+formulations as MetPy 1.7 (Ambaum 2020 saturation vapor pressure over liquid
+water, Bolton 1980 theta-e), see Benchmarks.py for the validation.
+
+"""
+
+import numpy as np
+
+from metpy.units import units
+
+# Constants matching metpy.constants
+Rd = 287.04749097718457      # J/(kg K)
+Cp_d = 1004.6662184201462    # J/(kg K)
+kappa = Rd / Cp_d
+epsilon = 0.6219569100577033 # Mw/Md
+Rv = 461.52311572606084      # J/(kg K)
+Cp_l = 4219.4                # J/(kg K)
+Cp_v = 1860.078011865639     # J/(kg K)
+Lv = 2500840.0               # J/kg
+T0 = 273.16                  # K
+E0 = 6.112                   # hPa
+P0 = 1000.0                  # hPa
+
+# Output columns of thermodynamics(), in getDataFrame_UpperAir order
+OUTPUT_UNITS = {'theta':'kelvin', 'theta_e':'kelvin', 'relative_humidity':'percent', 'u_wind':'knots', 'v_wind':'knots'}
+
+
+def saturationVaporPressure(T):
+    # T in K, returns hPa (liquid water)
+    latentHeat = Lv - (Cp_l - Cp_v) * (T - T0)
+    return E0 * (T0 / T) ** ((Cp_l - Cp_v) / Rv) * np.exp((Lv / T0 - latentHeat / T) / Rv)
+
+def potentialTemperature(p, T):
+    # p in hPa, T in K, returns K
+    return T * (P0 / p) ** kappa
+
+def equivalentPotentialTemperature(p, T, Td):
+    # p in hPa, T and Td in K, returns K
+    e = saturationVaporPressure(Td)
+    r = epsilon * e / (p - e)
+
+    T_lcl = 56.0 + 1.0 / (1.0 / (Td - 56.0) + np.log(T / Td) / 800.0)
+    theta_l = potentialTemperature(p - e, T) * (T / T_lcl) ** (0.28 * r)
+    return theta_l * np.exp(r * (1.0 + 0.448 * r) * (3036.0 / T_lcl - 1.78))
+
+def relativeHumidity(T, Td):
+    # T and Td in K, returns percent
+    return 100.0 * saturationVaporPressure(Td) / saturationVaporPressure(T)
+
+def windComponents(speed, direction):
+    # direction in degrees (meteorological), returns u, v in units of speed
+    direction = np.deg2rad(direction)
+    return -speed * np.sin(direction), -speed * np.cos(direction)
+
+def windDirection(u, v):
+    # Meteorological direction in degrees from u, v components
+    return np.rad2deg(np.arctan2(-u, -v)) % 360.0
+
+
+def thermodynamics(p, T, Td, speed, direction):
+    """
+    Derive theta, theta-e, RH and u/v for arrays of any shape, e.g. (hour x level).
+    Inputs are pint Quantities, converted once here, outputs are Quantity arrays
+    keyed as in OUTPUT_UNITS.
+    """
+    p = np.asarray(p.to('hPa').magnitude, dtype=float)
+    T = np.asarray(T.to('kelvin').magnitude, dtype=float)
+    Td = np.asarray(Td.to('kelvin').magnitude, dtype=float)
+    speed = np.asarray(speed.to('knots').magnitude, dtype=float)
+    direction = np.asarray(direction.to('degrees').magnitude, dtype=float)
+
+    u, v = windComponents(speed, direction)
+
+    return {'theta':potentialTemperature(p, T) * units.kelvin,
+            'theta_e':equivalentPotentialTemperature(p, T, Td) * units.kelvin,
+            'relative_humidity':relativeHumidity(T, Td) * units.percent,
+            'u_wind':u * units.knots,
+            'v_wind':v * units.knots}
+
+
+def soundingArrays(bufrData, hours):
+    """
+    Stack the surface row and sounding levels for the given forecast hours of a
+    bufkitProfile into (hour x level) Quantity arrays. Column 0 is the surface,
+    shorter soundings are padded with NaN.
+    """
+    soundings = [bufrData.SoundingParameters[hour+1] for hour in hours]
+    nLevels = 1 + max([len(sounding) for sounding in soundings] + [0])
+
+    fields = ['z', 'p', 'T', 'Td', 'speed', 'direction']
+    data = {field:np.full((len(hours), nLevels), np.nan) for field in fields}
+
+    for row, (hour, sounding) in enumerate(zip(hours, soundings)):
+        surfaceData = bufrData.SurfaceParameters[hour]
+
+        # Surface winds are stored as components (m/s)
+        uwnd = surfaceData.uwnd.to('knots').magnitude
+        vwnd = surfaceData.vwnd.to('knots').magnitude
+
+        data['z'][row, 0] = 0.0
+        data['p'][row, 0] = surfaceData.pres.to('hPa').magnitude
+        data['T'][row, 0] = surfaceData.t2ms.to('degC').magnitude
+        data['Td'][row, 0] = surfaceData.td2m.to('degC').magnitude
+        data['speed'][row, 0] = np.hypot(uwnd, vwnd)
+        data['direction'][row, 0] = windDirection(uwnd, vwnd)
+
+        # Sounding levels are parsed with fixed units, read magnitudes directly
+        n = len(sounding)
+        data['z'][row, 1:n+1] = [level.hght.magnitude for level in sounding]
+        data['p'][row, 1:n+1] = [level.pres.magnitude for level in sounding]
+        data['T'][row, 1:n+1] = [level.tmpc.magnitude for level in sounding]
+        data['Td'][row, 1:n+1] = [level.dwpc.magnitude for level in sounding]
+        data['speed'][row, 1:n+1] = [level.sknt.magnitude for level in sounding]
+        data['direction'][row, 1:n+1] = [level.drct.magnitude for level in sounding]
+
+    return {'z':data['z'] * units.meters,
+            'p':data['p'] * units.hPa,
+            'T':units.Quantity(data['T'], units.degC),
+            'Td':units.Quantity(data['Td'], units.degC),
+            'speed':data['speed'] * units.knots,
+            'direction':data['direction'] * units.degrees}